@@ -1,49 +1,49 @@
 #!/usr/bin/env python3
 # Initially created by airmack 21.Dec.2020
 
-from bs4 import BeautifulSoup
-import genanki
-from genanki.model import Model
-
 import time
 import logging
 
-BASIC_AND_REVERSED_CARD_JP_MODEL = Model(
-    12938895,
-    'Basic (and reversed card) (genanki)',
-    fields=[
-        {
-            'name': 'Kana',
-            'font': 'Arial',
-        },
-        {
-            'name': 'English',
-            'font': 'Arial',
-        },
-        {
-            'name': 'Kanji',
-            'font': 'Arial',
-        },
-        {
-            'name': 'Audio',
-            'font': 'Arial',
-        },
-
-    ],
-    templates=[
-        {
-            'name': 'Card 1',
-            'qfmt': '{{Kanji}}',
-            'afmt': '{{FrontSide}}\n\n<hr id=answer>\n\n{{Kana}}{{Audio}}<br>{{English}}',
-        },
-        {
-            'name': 'Card 2',
-            'qfmt': '{{English}}',
-            'afmt': '{{FrontSide}}\n\n<hr id=answer>\n\n{{Kanji}}<br>{{Kana}}{{Audio}}',
-        },
-    ],
-    css='.card {\n font-family: arial;\n font-size: 20px;\n text-align: center;\n color: black;\n background-color: white;\n}\n',
-)
+
+def createBasicAndReversedCardJpModel():
+    """genanki is only imported once a deck is actually written"""
+    from genanki.model import Model
+    return Model(
+        12938895,
+        'Basic (and reversed card) (genanki)',
+        fields=[
+            {
+                'name': 'Kana',
+                'font': 'Arial',
+            },
+            {
+                'name': 'English',
+                'font': 'Arial',
+            },
+            {
+                'name': 'Kanji',
+                'font': 'Arial',
+            },
+            {
+                'name': 'Audio',
+                'font': 'Arial',
+            },
+
+        ],
+        templates=[
+            {
+                'name': 'Card 1',
+                'qfmt': '{{Kanji}}',
+                'afmt': '{{FrontSide}}\n\n<hr id=answer>\n\n{{Kana}}{{Audio}}<br>{{English}}',
+            },
+            {
+                'name': 'Card 2',
+                'qfmt': '{{English}}',
+                'afmt': '{{FrontSide}}\n\n<hr id=answer>\n\n{{Kanji}}<br>{{Kana}}{{Audio}}',
+            },
+        ],
+        css='.card {\n font-family: arial;\n font-size: 20px;\n text-align: center;\n color: black;\n background-color: white;\n}\n',
+    )
 
 
 def createKeyIfNeeded(parent, cards):
@@ -59,6 +59,7 @@ class Language:
 
     def __init__(self):
         self.language = ""
+        self.cards = dict()
 
     def Scraper(self, root_url, lesson_soup):
         return []
@@ -121,9 +122,11 @@ class Japanese(Language):
 
     def CreateDeck(self, title):
         """Create a deck from all vocabulary entries"""
+        import genanki
+        model = createBasicAndReversedCardJpModel()
         deck = genanki.Deck(abs(hash(title)), title)
         for i in self.cards:
-            deck.add_note(genanki.Note(BASIC_AND_REVERSED_CARD_JP_MODEL, [self.cards[i].get("japanese_pronaunciation"), self.cards[i].get(
+            deck.add_note(genanki.Note(model, [self.cards[i].get("japanese_pronaunciation"), self.cards[i].get(
                 "english_definition"), self.cards[i].get("japanese_kana"), self.cards[i].get("japanese_audio")]))
         my_package = genanki.Package(deck)
         my_package.media_files = self.audio_files
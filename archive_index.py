@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# Searchable index of the downloaded lessons, their vocabulary and media files
+
+import argparse
+from os.path import expanduser
+from os import path
+
+import json
+import os
+import sqlite3
+import time
+
+from sys import exit
+from urllib.parse import quote
+
+import logging
+
+# Every table keeps its rows in a plain table keyed by an indexed lesson_url and a
+# full text index on top of it (external content), so replacing a lesson never scans the index.
+SCHEMA_VERSION = 1
+TABLES = {
+    "lessons": ["lesson_url", "pathway", "number", "title", "metadata"],
+    "vocabulary": ["kana", "pronunciation", "english", "audio", "lesson_url"],
+    "media": ["path", "kind", "lesson_url"],
+}
+SEARCHABLE_COLUMNS = {
+    "lessons": ["pathway", "title", "metadata"],
+    "vocabulary": ["kana", "pronunciation", "english"],
+    "media": ["path", "kind"],
+}
+
+
+class IndexSchemaError(Exception):
+    """The file is no archive index of this version"""
+
+
+def getDefaultIndexFile():
+    return expanduser("~") + "/.config/languagepod101/archive.sqlite"
+
+
+def quoteQuery(text):
+    """Turn plain search terms into an FTS5 query. Every term is matched literally, a trailing * keeps a prefix search."""
+    terms = []
+    for term in text.split():
+        prefix = term.endswith("*") and len(term) > 1
+        term = term.rstrip("*") if prefix else term
+        terms.append('"' + term.replace('"', '""') + '"' + ("*" if prefix else ""))
+    return " ".join(terms)
+
+
+class ArchiveIndex:
+    """SQLite FTS5 index of lessons, vocabulary and media. Every lesson is replaced as a whole, so it can be updated lesson by lesson."""
+
+    def __init__(self, index_file=None, read_only=False):
+        """Open an index, a new one is created unless read_only is set. Raises IndexSchemaError for any other database."""
+        self.index_file = expanduser(index_file or getDefaultIndexFile())
+        if read_only:
+            self.db = sqlite3.connect(
+                "file:" + quote(path.abspath(self.index_file)) + "?mode=ro", uri=True)
+        else:
+            index_dir = path.dirname(path.abspath(self.index_file))
+            if not path.exists(index_dir):
+                os.makedirs(index_dir)
+            self.db = sqlite3.connect(self.index_file)
+
+        try:
+            version = self.db.execute("PRAGMA user_version").fetchone()[0]
+            is_empty = self.db.execute(
+                "SELECT COUNT(*) FROM sqlite_master").fetchone()[0] == 0
+        except sqlite3.DatabaseError as e:
+            self.db.close()
+            raise IndexSchemaError(f"{self.index_file} is no SQLite database: {e}")
+        if version == SCHEMA_VERSION:
+            return
+        if read_only or not is_empty:
+            self.db.close()
+            raise IndexSchemaError(
+                f"{self.index_file} is no archive index of schema version {SCHEMA_VERSION}")
+        with self.db:
+            for table, columns in TABLES.items():
+                self.create_table(table, columns, SEARCHABLE_COLUMNS[table])
+            self.db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def create_table(self, table, columns, searchable):
+        self.db.execute(
+            f"CREATE TABLE IF NOT EXISTS {table}_rows (id INTEGER PRIMARY KEY, {', '.join(columns)})")
+        # A lesson is indexed once, its vocabulary and media are many rows each
+        unique = "UNIQUE " if table == "lessons" else ""
+        self.db.execute(
+            f"CREATE {unique}INDEX IF NOT EXISTS {table}_lesson_url ON {table}_rows (lesson_url)")
+        self.db.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {table} USING fts5({', '.join(searchable)}, "
+                        f"content='{table}_rows', content_rowid='id')")
+        new_values = ", ".join("new." + i for i in searchable)
+        old_values = ", ".join("old." + i for i in searchable)
+        self.db.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_insert AFTER INSERT ON {table}_rows BEGIN "
+                        f"INSERT INTO {table} (rowid, {', '.join(searchable)}) VALUES (new.id, {new_values}); END")
+        self.db.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_delete AFTER DELETE ON {table}_rows BEGIN "
+                        f"INSERT INTO {table} ({table}, rowid, {', '.join(searchable)}) VALUES ('delete', old.id, {old_values}); END")
+
+    def has_lesson(self, lesson_url):
+        return self.db.execute("SELECT 1 FROM lessons_rows WHERE lesson_url = ?", [lesson_url]).fetchone() is not None
+
+    def add_lesson(self, lesson_url, pathway, number, title, metadata, vocabulary, media):
+        """Index a lesson. vocabulary are the cards of anki_export.Japanese, media the paths of the saved files."""
+        with self.db:
+            for i in TABLES:
+                self.db.execute(
+                    f"DELETE FROM {i}_rows WHERE lesson_url = ?", [lesson_url])
+            self.db.execute("INSERT INTO lessons_rows (lesson_url, pathway, number, title, metadata) VALUES (?, ?, ?, ?, ?)",
+                            [lesson_url, pathway, number, title, json.dumps(metadata or {}, ensure_ascii=False)])
+            self.db.executemany("INSERT INTO vocabulary_rows (kana, pronunciation, english, audio, lesson_url) VALUES (?, ?, ?, ?, ?)",
+                                ([card.get("japanese_kana"), card.get("japanese_pronaunciation"), card.get("english_definition"),
+                                  card.get("audio_files"), lesson_url] for card in vocabulary))
+            self.db.executemany("INSERT INTO media_rows (path, kind, lesson_url) VALUES (?, ?, ?)",
+                                ([i, i.split('.')[-1].lower(), lesson_url] for i in media))
+        logging.debug(f"Indexed {lesson_url}")
+
+    def search(self, table, query, limit=20):
+        """Return the best matching rows for an FTS5 query e.g. '"taberu"' or 'たべ*', see quoteQuery for plain terms"""
+        if table not in TABLES:
+            raise ValueError(f"Unknown table {table}")
+        columns = ", ".join("r." + i for i in TABLES[table])
+        return self.db.execute(f"SELECT {columns} FROM {table} JOIN {table}_rows r ON r.id = {table}.rowid "
+                               f"WHERE {table} MATCH ? ORDER BY rank LIMIT ?",
+                               [query, limit]).fetchall()
+
+    def close(self):
+        self.db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Search the index of downloaded lessons, vocabulary and media')
+    parser.add_argument('query', nargs='+', help='Search terms, e.g. "eat", "たべ*" or a file path')
+    parser.add_argument('-t', '--table', default='vocabulary', choices=list(TABLES),
+                        help='What to search')
+    parser.add_argument('-n', '--limit', default=20, type=int,
+                        help='Maximum number of results')
+    parser.add_argument('--raw', action='store_true',
+                        help='Pass the query on as FTS5 syntax instead of plain terms')
+    parser.add_argument('--index_file', help='Index to search, defaults to ' + getDefaultIndexFile())
+    args = parser.parse_args()
+
+    index_file = expanduser(args.index_file or getDefaultIndexFile())
+    if not path.exists(index_file):
+        logging.error(f"No index found at {index_file}")
+        exit(1)
+
+    try:
+        index = ArchiveIndex(index_file, read_only=True)
+    except (IndexSchemaError, sqlite3.Error) as e:
+        logging.error(e)
+        exit(1)
+    start = time.perf_counter()
+    try:
+        query = " ".join(args.query)
+        rows = index.search(args.table, query if args.raw else quoteQuery(query), args.limit)
+    except sqlite3.OperationalError as e:
+        logging.error(e)
+        logging.error("Invalid query")
+        exit(1)
+    duration = time.perf_counter() - start
+    for row in rows:
+        print("\t".join("" if i is None else str(i) for i in row))
+    logging.info(f"{len(rows)} results in {duration * 1000:.1f} ms")
+    index.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(levelname)-8s %(message)s')
+    main()
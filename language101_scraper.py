@@ -2,15 +2,27 @@
 # language101 scraper helps you scrape full language courses from sites like
 # japanesepod101.com, spanishpod101.com, chineseclass101.com and more!
 
+import time
+
+# Taken before any other import, the startup timing breakdown starts here
+STARTUP_TIME = time.perf_counter()
+
 import argparse
 import configparser
 from os.path import expanduser
 from os import path
 
+from contextlib import contextmanager
 from getpass import getpass
+import gc
+import glob
+import itertools
 import pickle
+import queue
 import random
-import time
+import sqlite3
+import tempfile
+import threading
 
 import json
 import os
@@ -18,16 +30,13 @@ import os
 from sys import exit
 from urllib.parse import urlparse
 
-import requests
-
-from bs4 import BeautifulSoup
-import anki_export
-
 import logging
 
+# requests, bs4 and anki_export are imported where they are needed. A resume without anything to do never loads them.
+
 MAJOR_VERSION = 0
-MINOR_VERSION = 5
-PATCH_LEVEL = 7
+MINOR_VERSION = 6
+PATCH_LEVEL = 4
 
 VERSION_STRING = str(MAJOR_VERSION) + "." + \
     str(MINOR_VERSION) + "." + str(PATCH_LEVEL)
@@ -46,6 +55,246 @@ FAKE_BROWSER_HEADERS = {
     "upgrade-insecure-requests": "1"
 }
 
+# Renditions offered via 'data-quality', ordered from best to smallest
+VIDEO_QUALITY_RANKING = ["h", "m", "l"]
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Number of lessons read at once from a download stack that is paged to disk
+STACK_PAGE_SIZE = 100
+# Exit status once max_rss is reached, EX_TEMPFAIL tells cron and supervisors that a rerun continues
+EXIT_MEMORY_CEILING = 75
+
+
+class StartupTimer:
+    """Collects the duration of each startup phase for a timing breakdown"""
+
+    def __init__(self, start):
+        self.last = start
+        self.phases = []
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append([phase, now - self.last])
+        self.last = now
+
+    def skip(self):
+        """Leave out the time spent waiting for user input"""
+        self.last = time.perf_counter()
+
+    def report(self):
+        total = sum(duration for _, duration in self.phases)
+        breakdown = ", ".join(
+            f"{phase} {duration:.3f}s" for phase, duration in self.phases)
+        logging.info(f"Startup took {total:.3f}s ({breakdown})")
+
+
+STARTUP_TIMER = StartupTimer(STARTUP_TIME)
+
+
+def get_current_rss():
+    """Return the resident set size of this process in bytes or None if it can't be measured"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except Exception:
+        pass
+    try:
+        import resource
+        # Peak instead of current RSS, reported in kilobytes on Linux and bytes on macOS
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if os.uname().sysname == "Darwin" else rss * 1024
+    except Exception:
+        return None
+
+
+def write_file_atomically(file_name, content):
+    """Write into a temporary file next to file_name and move it into place"""
+    fd, tmp_name = tempfile.mkstemp(dir=path.dirname(file_name),
+                                    prefix=path.basename(file_name))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_name, file_name)
+    except Exception:
+        os.remove(tmp_name)
+        raise
+
+
+class BandwidthLimiter:
+    """Caps the combined rate of all transfers sharing this limiter.
+       Every chunk reserves a time slot proportional to its size, callers sleep until their slot is due."""
+
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = bytes_per_second
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        if not self.bytes_per_second:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.next_slot = max(now, self.next_slot) + \
+                amount / self.bytes_per_second
+            delay = self.next_slot - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+class SessionPool:
+    """Holds a small pool of logged in sessions for concurrent workers, the download itself currently runs one request at a time.
+       Every response is checked for a lost login, affected sessions are re-authenticated and the request is repeated."""
+
+    def __init__(self, root_url, login_url, username, password, size=1, max_age=None):
+        self.root_url = root_url
+        self.login_url = login_url
+        self.username = username
+        self.password = password
+        self.size = max(1, size or 1)
+        self.max_age = max_age
+        self.m_idle = queue.Queue()
+        self.m_sessions = []
+        self.m_logged_in_at = dict()
+        self.m_lock = threading.Lock()
+        self.m_fill_lock = threading.Lock()
+
+    def new_session(self):
+        import requests
+        session = requests.Session()
+        session.headers.update(FAKE_BROWSER_HEADERS)
+        return session
+
+    def check_if_authenticated(self, response):
+        try:
+            response.raise_for_status()
+        except Exception as e:
+            logging.error(e)
+            logging.error(
+                'Could not reach site. Please check URL and internet connection.')
+            exit(1)
+
+        if 'X-Ill-Member' not in response.headers:
+            return False
+        return True
+
+    def is_logged_out(self, response):
+        """Detect responses that were served to a logged out session"""
+        for i in response.history + [response]:
+            if '/member/login' in urlparse(i.headers.get('location', i.url)).path:
+                return True
+        # Media is served from other hosts which never send the member header
+        if urlparse(response.url).netloc != urlparse(self.root_url).netloc:
+            return False
+        if 'text/html' not in response.headers.get('content-type', ''):
+            return False
+        return 'X-Ill-Member' not in response.headers
+
+    def restore(self, session, cookies, logged_in_at):
+        """Reuse old cookies without a round trip, a stale login is detected on the first response.
+           logged_in_at is the time of the original login, session_max_age keeps counting from there."""
+        session.cookies.update(cookies)
+        self.m_logged_in_at[id(session)] = logged_in_at
+
+    def login(self, session):
+        """Log in with the credentials"""
+        session.cookies.clear()
+        credentials = {'amember_login': self.username,
+                       'amember_pass': self.password}
+        response = session.post(self.login_url, data=credentials)
+        logged_in = self.check_if_authenticated(response)
+        if logged_in:
+            self.m_logged_in_at[id(session)] = time.time()
+        return logged_in
+
+    def reauthenticate(self, session):
+        logging.info('Session expired, logging in again.')
+        if not self.login(session):
+            logging.error('Could not log in. Please check your credentials.')
+            exit(1)
+        self.place_cookie()
+
+    def authenticate(self):
+        """Fill the pool via old sessions or new ones"""
+        logging.debug(f'Trying to log in to {self.root_url}')
+        cached_cookies = self.load_cookie()
+        for i in range(self.size):
+            session = self.new_session()
+            if i < len(cached_cookies):
+                self.restore(session, *cached_cookies[i])
+                logging.info('Restored old session.')
+            elif self.login(session):
+                logging.info('Sucessfully logged in with new session.')
+            else:
+                logging.error(
+                    'Could not log in. Please check your credentials.')
+                exit(1)
+            self.m_sessions.append(session)
+            self.m_idle.put(session)
+        self.place_cookie()
+
+    def fill(self):
+        """Authenticate once, before the first session is handed out"""
+        with self.m_fill_lock:
+            if not self.m_sessions:
+                self.authenticate()
+
+    @contextmanager
+    def acquire(self):
+        """Borrow a session exclusively, it is handed back to the pool afterwards"""
+        self.fill()
+        session = self.m_idle.get()
+        try:
+            if self.max_age and time.time() - self.m_logged_in_at.get(id(session), 0) > self.max_age:
+                logging.debug('Refreshing session proactively')
+                self.reauthenticate(session)
+            yield session
+        finally:
+            self.m_idle.put(session)
+
+    @contextmanager
+    def get(self, url, **kwargs):
+        """GET via a pooled session, repeating the request once after a re-authentication.
+           The session stays leased until the with block ends and the response is closed, streamed bodies included."""
+        with self.acquire() as session:
+            response = session.get(url, **kwargs)
+            if self.is_logged_out(response):
+                response.close()
+                self.reauthenticate(session)
+                response = session.get(url, **kwargs)
+            try:
+                yield response
+            finally:
+                response.close()
+
+    def place_cookie(self):
+        """Store the cookies of all sessions together with their login time atomically"""
+        cookiepath = expanduser("~") + "/.config/languagepod101/"
+        cookie_file = "lastsession"
+        with self.m_lock:
+            if not path.exists(cookiepath):
+                os.makedirs(cookiepath)
+            cookies = [[i.cookies.get_dict(), self.m_logged_in_at.get(id(i), 0)]
+                       for i in self.m_sessions]
+            write_file_atomically(cookiepath + cookie_file, pickle.dumps(cookies))
+
+    def load_cookie(self):
+        cookiepath = expanduser("~") + "/.config/languagepod101/"
+        cookie_file = "lastsession"
+        if not path.exists(cookiepath+cookie_file):
+            return []
+        with open(cookiepath + cookie_file, 'rb') as f:
+            try:
+                content = pickle.load(f)
+                # Older versions stored the cookies of a single session
+                if isinstance(content, dict):
+                    content = [content]
+                # Cookies stored without a login time count as expired for session_max_age
+                return [i if isinstance(i, list) else [i, 0] for i in content]
+            except Exception as e:
+                logging.error(e)
+                logging.error("Restoring from cookie failed")
+        return []
+
 
 class LanguagePod101Downloader:
     """Wrapper class for storing states e.g. arguments or config states"""
@@ -54,18 +303,31 @@ class LanguagePod101Downloader:
         self.m_arguments = vars(args)
         self.sanity_check()
         self.pdf_sanity_issue_warned = False
+        self.m_bandwidth_limiter = BandwidthLimiter(
+            self.m_arguments.get("max_bandwidth"))
+        # Files saved for the current lesson, they end up in the archive index
+        self.m_saved_files = []
+        self.m_index = None
 
     def sanity_check(self):
-        boolean_values = ["video", "audio", "document", "anki_deck"]
-        for i in ["video", "audio", "document", "anki_deck"]:
-            if type(self.m_arguments.get(i)) is not bool:
+        boolean_values = ["video", "audio", "document",
+                          "anki_deck", "download_all_videos", "low_memory", "force_new_download_stack", "index"]
+        for i in boolean_values:
+            if type(self.m_arguments.get(i)) is str:
                 self.m_arguments[i] = self.m_arguments.get(i).lower() in [
                     'true', '1', 't', 'y', 'yes', 'yeah', 'yup', 'certainly', 'uh-huh']  # convert to bool
 
-        for i in ["min_delay", "max_delay"]:
+        for i in ["min_delay", "max_delay", "max_bandwidth", "session_pool_size", "session_max_age", "max_rss", "refresh_interval"]:
             if type(self.m_arguments.get(i)) is str:
                 self.m_arguments[i] = int(self.m_arguments.get(i))
 
+        if self.m_arguments.get("max_bandwidth") is not None and self.m_arguments["max_bandwidth"] <= 0:
+            logging.warning("Bandwidth cap needs to be positive, downloading without a cap")
+            self.m_arguments["max_bandwidth"] = None
+
+        self.m_arguments["video_quality"] = self.parse_video_quality(
+            self.m_arguments.get("video_quality"))
+
         minD = self.m_arguments.get("min_delay")
         maxD = self.m_arguments.get("max_delay")
         # check if min and max value are really min and max
@@ -83,6 +345,27 @@ class LanguagePod101Downloader:
         debugConfigWithoutPassword["password"] = 8 * "*"
         logging.debug(debugConfigWithoutPassword)
 
+    def parse_video_quality(self, policy):
+        """Turn the video_quality setting into a list of qualities ordered by preference.
+           None stands for downloading every rendition."""
+        policy = (policy or "best").lower().strip()
+        if self.m_arguments.get("download_all_videos") or policy == "all":
+            return None
+        if policy == "best":
+            return list(VIDEO_QUALITY_RANKING)
+        if policy == "smallest":
+            return list(reversed(VIDEO_QUALITY_RANKING))
+
+        preferred = [i.strip() for i in policy.split(",") if i.strip()]
+        for i in preferred:
+            if i not in VIDEO_QUALITY_RANKING:
+                logging.warning(f'Unknown video quality "{i}"')
+        if not preferred:
+            logging.warning(
+                "Video quality is not correctly set, falling back to: best")
+        # Fallback is the remaining renditions from best to smallest
+        return preferred + [i for i in VIDEO_QUALITY_RANKING if i not in preferred]
+
     def parse_url(self, url):
         """Parse the course URL"""
         obj = urlparse(url)
@@ -91,69 +374,23 @@ class LanguagePod101Downloader:
 
         return root_url, login_url
 
-    def place_cookie(self, session_cookie):
-        cookiepath = expanduser("~") + "/.config/languagepod101/"
-        cookie_file = "lastsession"
-        if not path.exists(cookiepath):
-            os.makedirs(cookiepath)
-        with open(cookiepath + cookie_file, 'wb') as f:
-            pickle.dump(session_cookie, f)
-
-    def load_cookie(self):
-        cookiepath = expanduser("~") + "/.config/languagepod101/"
-        cookie_file = "lastsession"
-        if not path.exists(cookiepath+cookie_file):
-            return None
-        with open(cookiepath + cookie_file, 'rb') as f:
-            try:
-                content = pickle.load(f)
-                return content
-            except Exception as e:
-                logging.error(e)
-                logging.error("Restoring from cookie failed")
-        return None
-
-    def check_if_authenticated(self, response):
-        returnValue = False
-        try:
-            response.raise_for_status()
-        except Exception as e:
-            logging.error(e)
-            logging.error(
-                'Could not reach site. Please check URL and internet connection.')
-            exit(1)
-
-        if 'X-Ill-Member' not in response.headers:
-            return False
-        return True
-
     def authenticate(self, url, username, password):
-        """Logs in to the website via an old session or a new one"""
+        """Logs in to the website via old sessions or new ones"""
         root_url, login_url = self.parse_url(url)
-
-        logging.debug(f'Trying to log in to {root_url}')
-        self.m_session = requests.Session()
-        cachedSession = False
-        loadCookie = self.load_cookie()
-        self.m_session.headers.update(FAKE_BROWSER_HEADERS)
-
-        if loadCookie is not None:
-            self.m_session.cookies.update(loadCookie)
-            response = self.m_session.post(login_url)
-            if self.check_if_authenticated(response):
-                logging.info('Sucessfully logged in via old session.')
-                cachedSession = True
-                return
-        if not cachedSession:
-            credentials = {'amember_login': username, 'amember_pass': password}
-            response = self.m_session.post(login_url, data=credentials)
-            self.place_cookie(self.m_session.cookies.get_dict())
-            if self.check_if_authenticated(response):
-                logging.info('Sucessfully logged in with new session.')
-                return
-        if not self.check_if_authenticated(response):
-            logging.error('Could not log in. Please check your credentials.')
-            exit(1)
+        self.m_sessions = SessionPool(root_url, login_url, username, password,
+                                      self.m_arguments.get("session_pool_size"),
+                                      self.m_arguments.get("session_max_age"))
+        self.m_sessions.fill()
+
+    def import_dependencies(self):
+        """Import the heavy modules of the enabled features up front, so their cost shows up in the startup timing"""
+        import requests
+        import bs4
+        import lxml.etree
+        if self.m_arguments.get("anki_deck"):
+            import genanki
+        if self.m_arguments.get("index"):
+            import archive_index
 
     def download_audios(self, lesson_number, lesson_soup):
         """Download the audio files of a lesson"""
@@ -199,8 +436,9 @@ class LanguagePod101Downloader:
 
                     self.save_file(file_url, file_name)
 
-    def download_vocabulary(self, root_url, lesson_soup):
-        """Download the vocabulary, currently only japanese is supported. This should be extended """
+    def scrape_vocabulary(self, root_url, lesson_soup):
+        """Parse the vocabulary, currently only japanese is supported. This should be extended """
+        import anki_export
         voc_scraper = anki_export.Language()
         downloadList = []
         if root_url.lower().find("japanese") != -1:
@@ -208,11 +446,17 @@ class LanguagePod101Downloader:
             downloadList = voc_scraper.Scraper(root_url, lesson_soup)
         else:
             logging.warning("Unknown language")
+        return voc_scraper, downloadList
 
+    def download_vocabulary(self, root_url, lesson_soup):
+        """Download the vocabulary and create an anki deck from it"""
+        voc_scraper, downloadList = self.scrape_vocabulary(
+            root_url, lesson_soup)
         for i in downloadList:
             name = i.split('/')[-1]
             self.save_file(i, name)
         voc_scraper.CreateDeck(lesson_soup.title.text)
+        return voc_scraper
 
     def download_pdfs(self, root_url, lesson_soup):
         """Download the PDF files of a lesson"""
@@ -226,6 +470,30 @@ class LanguagePod101Downloader:
                 pdf_name = pdf_url.split('/')[-1]
                 self.save_file(pdf_url, pdf_name)
 
+    def select_video_sources(self, video_soup):
+        """Return quality and URL of the mp4 renditions chosen by the video quality policy"""
+        renditions = []
+        for video_file in video_soup:
+            try:
+                if video_file['type'] == 'video/mp4':
+                    renditions.append(
+                        [video_file.get('data-quality'), video_file['src']])
+            except Exception as e:
+                logging.warning(e)
+                logging.warning(
+                    'Could not find out the URL for this lesson\'s video.')
+
+        preference = self.m_arguments.get("video_quality")
+        if preference is None:
+            return renditions
+
+        for quality in preference:
+            for rendition in renditions:
+                if rendition[0] == quality:
+                    return [rendition]
+        # None of the known qualities is offered, take whatever there is
+        return renditions[:1]
+
     def download_videos(self, lesson_number, lesson_soup):
         """Download the video files of a lesson"""
         video_soup = lesson_soup.find_all('source')
@@ -233,19 +501,8 @@ class LanguagePod101Downloader:
         if video_soup:
             logging.info(
                 f'Downloading Lesson {str(lesson_number).zfill(3)} - {lesson_soup.title.text} video')
-            for video_file in video_soup:
-                try:
-                    if video_file['type'] == 'video/mp4':
-                        if self.m_arguments["download_all_videos"] or video_file['data-quality'] == 'h' or video_file['data-quality'] == 'm':
-                            file_url = video_file['src']
-                    else:
-                        continue
-                except Exception as e:
-                    logging.warning(e)
-                    logging.warning(
-                        'Could not find out the URL for this lesson\'s video.')
-                    continue
-
+            selected = self.select_video_sources(video_soup)
+            for i, [quality, file_url] in enumerate(selected):
                 # Verifies that the file is in 'mp4' or 'm4v' format.
                 # If so, builds a clean str name for the file:
                 if file_url.endswith('.mp4') or file_url.endswith('.m4v'):
@@ -257,6 +514,9 @@ class LanguagePod101Downloader:
                     file_body = self.get_filename_body(lesson_soup)
                     file_ext = file_url.split('.')[-1]
                     file_name = f'{file_prefix} - {file_body}.{file_ext}'
+                    if len(selected) > 1:
+                        # Several renditions need to be told apart by their quality
+                        file_name = f'{file_prefix} - {file_body} - {quality or i}.{file_ext}'
 
                     self.save_file(file_url, file_name)
 
@@ -274,17 +534,21 @@ class LanguagePod101Downloader:
 
     def get_soup(self, url):
         """Return the BeautifulSoup object for the given URL"""
-        res = self.m_session.get(url)
-        try:
-            res.raise_for_status()
-        except Exception as e:
-            logging.error(e)
-            logging.error(
-                'Could not download web page. Please make sure the URL is accurate.')
-            exit(1)
+        from bs4 import BeautifulSoup
+        with self.m_sessions.get(url) as res:
+            try:
+                res.raise_for_status()
+            except Exception as e:
+                logging.error(e)
+                logging.error(
+                    'Could not download web page. Please make sure the URL is accurate.')
+                exit(1)
+            content = res.content
+        # Pages count towards the bandwidth cap just like the saved files
+        self.m_bandwidth_limiter.consume(len(content))
 
         try:
-            soup = BeautifulSoup(res.text, 'lxml')
+            soup = BeautifulSoup(content, 'lxml')
         except Exception as e:
             logging.error(e)
             logging.error(
@@ -294,7 +558,7 @@ class LanguagePod101Downloader:
         return soup
 
     def get_lessons_urls(self, pathway_url):
-        """Return a list of the URLs of the lessons in the given pathway URL"""
+        """Return the URLs of the lessons in the given pathway URL together with their 'data-collection-entries' metadata"""
         root_url, _ = self.parse_url(pathway_url)
         pathway_soup = self.get_soup(pathway_url)
         div = pathway_soup.select_one('#pw_page')
@@ -303,10 +567,12 @@ class LanguagePod101Downloader:
         except:
 
             logging.warning(f'Could not parse {pathway_url}')
-            return []
+            return dict()
+        finally:
+            self.release_soup(pathway_soup)
 
-        lessons_urls = [root_url + entry['url']
-                        for entry in entries if entry.get('url')]
+        lessons_urls = dict([root_url + entry['url'], entry]
+                            for entry in entries if entry.get('url'))
         return lessons_urls
 
     def get_pathways_urls(self, level_url):
@@ -317,6 +583,7 @@ class LanguagePod101Downloader:
         pathways_links = level_soup.select(f'a[data-{level_name}="1"]')
         pathways_urls = set([root_url + link['href']
                              for link in pathways_links])
+        self.release_soup(level_soup)
         return pathways_urls
 
     def download_pathway(self, pathway_url):
@@ -347,31 +614,74 @@ class LanguagePod101Downloader:
         pathways_urls = self.get_pathways_urls(level_url)
         return [level_name, pathways_urls]
 
-    def create_stack_for_level(self, level_url):
+    def new_download_stack(self, level_url):
+        """Create an empty stack. In low memory mode its lessons go straight into the stack database."""
         stack = dict()
-        [level_name, pathways_urls] = self.download_level(level_url)
-        logging.info(pathways_urls)
         stack["version"] = __version__
-        stack["lesson"] = dict()
         stack["start_url"] = level_url
+        if self.m_arguments.get("low_memory"):
+            stack["lesson"] = None
+            stack["paged"] = True
+            db = self.open_stack_db()
+            with db:
+                db.execute("DELETE FROM lesson")
+            db.close()
+        else:
+            stack["lesson"] = dict()
+        return stack
+
+    def add_lessons_to_stack(self, stack, lesson_path, lessons):
+        """Add the lessons of a pathway, a paged stack gets them inserted while the level is still crawled"""
+        if not stack.get("paged"):
+            for j in lessons:
+                stack["lesson"][j] = [lesson_path, lessons[j], False]
+            return
+        db = self.open_stack_db()
+        with db:
+            # Same as the dict: a lesson listed twice keeps its position but takes the last pathway
+            db.executemany("INSERT INTO lesson (url, path, meta, finished) VALUES (?, ?, ?, 0) "
+                           "ON CONFLICT(url) DO UPDATE SET path = excluded.path, meta = excluded.meta",
+                           ([j, lesson_path, json.dumps(lessons[j])] for j in lessons))
+        db.close()
+
+    def page_out_download_stack(self, stack):
+        """Move the lessons of a stack created without low_memory into the stack database, finished flags are kept"""
+        paged_stack = self.new_download_stack(stack["start_url"])
+        finished = []
+        for lesson_path, entries in itertools.groupby(self.iterate_stack(stack), key=lambda i: i[1]):
+            lessons = dict()
+            for url, _, metadata, isFinished in entries:
+                lessons[url] = metadata
+                if isFinished:
+                    finished.append([url])
+            self.add_lessons_to_stack(paged_stack, lesson_path, lessons)
+        db = self.open_stack_db()
+        with db:
+            db.executemany(
+                "UPDATE lesson SET finished = 1 WHERE url = ?", finished)
+        db.close()
+        self.save_download_stack(paged_stack)
+        logging.debug("Download stack paged to disk")
+        return paged_stack
+
+    def create_stack_for_level(self, level_url):
+        [level_name, pathways_urls] = self.download_level(level_url)
+        logging.info(pathways_urls)
+        stack = self.new_download_stack(level_url)
         for i in pathways_urls:
             [pathway_name, lessons] = self.download_pathway(i)
-            logging.info(lessons)
-            for j in lessons:
-                stack["lesson"][j] = [level_name + pathway_name, False]
+            logging.info(list(lessons))
+            self.add_lessons_to_stack(
+                stack, level_name + pathway_name, lessons)
         self.save_download_stack(stack)
         return stack
 
     def create_stack_for_lesson(self, level_url):
-        stack = dict()
         logging.info(level_url)
-        stack["version"] = __version__
-        stack["lesson"] = dict()
-        stack["start_url"] = level_url
+        stack = self.new_download_stack(level_url)
         [pathway_name, lessons] = self.download_pathway(level_url)
-        logging.info(lessons)
-        for j in lessons:
-            stack["lesson"][j] = [pathway_name, False]
+        logging.info(list(lessons))
+        self.add_lessons_to_stack(stack, pathway_name, lessons)
         self.save_download_stack(stack)
         return stack
 
@@ -380,7 +690,7 @@ class LanguagePod101Downloader:
         try:
             logging.debug("Trying level download")
             returnvalue = self.create_stack_for_level(level_url)
-            if not returnvalue["lesson"]:
+            if self.count_pending_lessons(returnvalue) == 0:
                 logging.debug("Returned empty level")
                 logging.debug("Assuming lesson download")
                 returnvalue = self.create_stack_for_lesson(level_url)
@@ -390,6 +700,55 @@ class LanguagePod101Downloader:
             returnvalue = self.create_stack_for_lesson(level_url)
         return returnvalue
 
+    def open_stack_db(self, stack_db="laststack.db"):
+        stackpath = expanduser("~") + "/.config/languagepod101/"
+        if not path.exists(stackpath):
+            os.makedirs(stackpath)
+        db = sqlite3.connect(stackpath + stack_db)
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS lesson (id INTEGER PRIMARY KEY, url TEXT UNIQUE, path TEXT, meta TEXT, finished INTEGER)")
+        if "meta" not in [i[1] for i in db.execute("PRAGMA table_info(lesson)")]:
+            # Stacks paged by 0.6.2 did not store the lesson metadata
+            db.execute("ALTER TABLE lesson ADD COLUMN meta TEXT")
+        return db
+
+    def get_lesson_metadata(self, entry):
+        """Stack entries are [path, metadata, done?], stacks of older versions have no metadata"""
+        return entry[1] if len(entry) > 2 else dict()
+
+    def iterate_stack(self, stack):
+        """Yield lesson url, path, metadata and state of the stack in the order of creation"""
+        if not stack.get("paged"):
+            for url, entry in stack["lesson"].items():
+                yield url, entry[0], self.get_lesson_metadata(entry), entry[-1]
+            return
+
+        db = self.open_stack_db(stack.get("paged_db", "laststack.db"))
+        last_id = 0
+        try:
+            while True:
+                page = db.execute("SELECT id, url, path, meta, finished FROM lesson WHERE id > ? ORDER BY id LIMIT ?",
+                                  [last_id, STACK_PAGE_SIZE]).fetchall()
+                if not page:
+                    break
+                for lesson_id, url, lesson_path, meta, finished in page:
+                    last_id = lesson_id
+                    yield url, lesson_path, json.loads(meta or "{}"), bool(finished)
+        finally:
+            db.close()
+
+    def mark_lesson_finished(self, stack, lesson_url):
+        if not stack.get("paged"):
+            stack["lesson"][lesson_url][-1] = True
+            self.save_download_stack(stack)
+            return
+        db = self.open_stack_db(stack.get("paged_db", "laststack.db"))
+        with db:
+            db.execute("UPDATE lesson SET finished = 1 WHERE url = ?", [lesson_url])
+        db.close()
+        self.save_stack_state(
+            {"start_url": stack["start_url"], "pending": self.count_pending_lessons(stack)})
+
     def save_download_stack(self, stack):
         stackpath = expanduser("~") + "/.config/languagepod101/"
         stack_file = "laststack"
@@ -398,6 +757,64 @@ class LanguagePod101Downloader:
         with open(stackpath + stack_file, 'wb') as f:
             pickle.dump(stack, f)
         logging.debug("Download stack stored")
+        if stack is not None:
+            self.save_stack_state(
+                {"start_url": stack["start_url"], "pending": self.count_pending_lessons(stack)})
+
+    def count_pending_lessons(self, stack):
+        if not stack.get("paged"):
+            return sum(1 for entry in stack["lesson"].values() if not entry[-1])
+        db = self.open_stack_db(stack.get("paged_db", "laststack.db"))
+        pending = db.execute(
+            "SELECT COUNT(*) FROM lesson WHERE finished = 0").fetchone()[0]
+        db.close()
+        return pending
+
+    def save_stack_state(self, state):
+        """Store a small summary of the download stack, it is checked on startup without unpickling the stack"""
+        stackpath = expanduser("~") + "/.config/languagepod101/"
+        state_file = "laststack.state"
+        if not path.exists(stackpath):
+            os.makedirs(stackpath)
+        state["version"] = __version__
+        write_file_atomically(stackpath + state_file,
+                              json.dumps(state).encode())
+
+    def load_stack_state(self):
+        stackpath = expanduser("~") + "/.config/languagepod101/"
+        state_file = "laststack.state"
+        try:
+            with open(stackpath + state_file) as f:
+                return json.load(f)
+        except Exception as e:
+            logging.debug(e)
+            logging.debug("No download stack state found")
+        return None
+
+    def nothing_to_do(self, level_url):
+        """Check against the stored state whether a run would download anything, no network access needed"""
+        if self.force_new_download_stack():
+            return False
+        state = self.load_stack_state()
+        if state is None or state.get("version") != __version__ or state.get("start_url") != level_url:
+            return False
+        if state.get("completed"):
+            refresh_interval = self.m_arguments.get("refresh_interval")
+            return bool(refresh_interval) and time.time() - state["completed"] < refresh_interval
+        if state.get("pending") == 0:
+            # Interrupted right after the last lesson, only the cleanup is missing
+            self.finish_download_stack(level_url)
+            return True
+        return False
+
+    def finish_download_stack(self, start_url):
+        stackpath = expanduser("~") + "/.config/languagepod101/"
+        # The finished stack is kept aside, the archive index can be filled from it later on
+        for stack_file, finished_file in [["laststack", "laststack.finished"], ["laststack.db", "laststack.finished.db"]]:
+            if path.exists(stackpath + stack_file):
+                os.replace(stackpath + stack_file, stackpath + finished_file)
+        self.save_stack_state({"start_url": start_url,
+                               "pending": 0, "completed": time.time()})
 
     def load_download_stack(self):
         stackpath = expanduser("~") + "/.config/languagepod101/"
@@ -407,6 +824,9 @@ class LanguagePod101Downloader:
             with open(stackpath + stack_file, 'rb') as f:
                 try:
                     stack = pickle.load(f)
+                    if stack is None:
+                        logging.debug("Last download stack was finished")
+                        return None
                     if stack["version"] != __version__:
                         logging.warning(
                             "Attention trying to use an old download stack with a newer version, this might cause undefined behavior. If you are unsure create a backup and continue with YES.")
@@ -415,7 +835,12 @@ class LanguagePod101Downloader:
                         logging.info("Rewriting version of download stack")
                         stack["version"] = __version__
                         self.save_download_stack(stack)
+                    if stack.get("paged") and not path.exists(stackpath + "laststack.db"):
+                        logging.error("Paged download stack is missing its lessons")
+                        return None
                     logging.debug("Download stack restored")
+                    if self.m_arguments.get("low_memory") and not stack.get("paged"):
+                        stack = self.page_out_download_stack(stack)
                     return stack
                 except Exception as e:
                     logging.error(e)
@@ -439,46 +864,168 @@ class LanguagePod101Downloader:
 
         return returnvalue
 
+    def iter_content_throttled(self, response):
+        """Stream the response body while honouring the bandwidth cap"""
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            self.m_bandwidth_limiter.consume(len(chunk))
+            yield chunk
+
     def save_file(self, file_url, file_name):
         """Save file on local folder"""
         if os.path.isfile(file_name):
             logging.debug(f'{file_name} was already downloaded.')
+            self.m_saved_files.append(os.path.abspath(file_name))
             return
 
+        # Write into a partial file first, an aborted transfer must not look like a finished download
+        partial_name = file_name + ".part"
         try:
-            lesson_response = self.m_session.get(file_url)
-            if file_name[-3:].lower() == "pdf":
-                if not self.is_sane_pdf(file_name, lesson_response.content):
-                    return  # return if sanity_check fails
-
-            with open(file_name, 'wb') as f:
-                f.write(lesson_response.content)
-                logging.info(f'{file_name} saved on local device!')
+            with self.m_sessions.get(file_url, stream=True) as lesson_response:
+                chunks = self.iter_content_throttled(lesson_response)
+                if file_name[-3:].lower() == "pdf":
+                    content = b"".join(chunks)
+                    if not self.is_sane_pdf(file_name, content):
+                        return  # return if sanity_check fails
+                    chunks = [content]
+
+                with open(partial_name, 'wb') as f:
+                    for chunk in chunks:
+                        f.write(chunk)
+            os.replace(partial_name, file_name)
+            self.m_saved_files.append(os.path.abspath(file_name))
+            logging.info(f'{file_name} saved on local device!')
         except Exception as e:
             logging.warning(e)
             logging.warning(f'Failed to save {file_name} on local device.')
+            if os.path.isfile(partial_name):
+                os.remove(partial_name)
+
+    def open_index(self):
+        """Open the archive index, lessons are added as soon as they are finished.
+           Lessons finished before the index was enabled are added from their saved pages."""
+        if self.m_index is not None:
+            return
+        import archive_index
+        try:
+            self.m_index = archive_index.ArchiveIndex(
+                self.m_arguments.get("index_file"))
+        except archive_index.IndexSchemaError as e:
+            logging.error(e)
+            logging.error(
+                'Please choose another index_file, it is left untouched.')
+            exit(1)
+        except sqlite3.OperationalError as e:
+            logging.error(e)
+            logging.error(
+                'Could not open the archive index, SQLite might have been built without FTS5.')
+            exit(1)
+
+    def backfill_index(self):
+        """Index the lessons of the last finished download from their saved pages, no network needed"""
+        stackpath = expanduser("~") + "/.config/languagepod101/"
+        stack_file = "laststack.finished"
+        try:
+            with open(stackpath + stack_file, 'rb') as f:
+                stack = pickle.load(f)
+        except Exception as e:
+            logging.debug(e)
+            logging.debug("No finished download stack found")
+            return
+        if stack is None or stack.get("indexed"):
+            return
+        if stack.get("paged"):
+            stack["paged_db"] = "laststack.finished.db"
+
+        lessons_counter = dict()
+        missing = 0
+        for lesson_url, lesson_path, metadata, _ in self.iterate_stack(stack):
+            lessons_counter[lesson_path] = lessons_counter.get(
+                lesson_path, 0) + 1
+            if not self.m_index.has_lesson(lesson_url):
+                if not self.index_saved_lesson(lesson_url, lesson_path, lessons_counter[lesson_path], metadata):
+                    missing += 1
+        if missing:
+            # Retried on the next run, the saved pages might just be somewhere else
+            logging.warning(
+                f"{missing} lessons of the last finished download have no saved page below {os.getcwd()}.")
+            logging.warning(
+                "Run from the folder the level was downloaded to for indexing them.")
+            return
+        stack["indexed"] = True
+        write_file_atomically(stackpath + stack_file, pickle.dumps(stack))
+        logging.info("Archive index is up to date with the last finished download")
+
+    def index_saved_lesson(self, lesson_url, lesson_path, lesson_number, metadata):
+        """Index a finished lesson from its saved page and the files next to it, no network needed.
+           Returns False if the page was not found."""
+        from bs4 import BeautifulSoup
+        file_prefix = glob.escape(str(lesson_number).zfill(3) + " - ")
+        pages = glob.glob(os.path.join(
+            glob.escape(lesson_path), file_prefix + "*.html"))
+        if not pages:
+            logging.debug(
+                f"No saved page for {lesson_url}, it can't be indexed")
+            return False
+        with open(pages[0], 'rb') as f:
+            lesson_soup = BeautifulSoup(f.read(), 'lxml')
+
+        root_url, _ = self.parse_url(lesson_url)
+        voc_scraper, downloadList = self.scrape_vocabulary(
+            root_url, lesson_soup)
+        media = [i for i in glob.glob(os.path.join(glob.escape(lesson_path), file_prefix + "*"))
+                 if not i.endswith(".part")]
+        media += [i for i in (os.path.join(lesson_path, j.split('/')[-1]) for j in downloadList)
+                  if os.path.isfile(i)]
+        self.m_index.add_lesson(lesson_url, lesson_path, lesson_number, lesson_soup.title.text, metadata,
+                                list(voc_scraper.cards.values()), [os.path.abspath(i) for i in media])
+        self.release_soup(lesson_soup)
+        return True
+
+    def release_soup(self, soup):
+        """Free a parsed page right away instead of waiting for the garbage collector"""
+        if self.m_arguments.get("low_memory"):
+            soup.decompose()
+
+    def check_memory_ceiling(self):
+        """Return True once the process grows beyond max_rss megabytes"""
+        if self.m_arguments.get("low_memory"):
+            gc.collect()
+        rss = get_current_rss()
+        if rss is None:
+            return False
+        logging.debug(f"Resident memory: {rss // (1024 * 1024)} MB")
+        max_rss = self.m_arguments.get("max_rss")
+        if max_rss and rss > max_rss * 1024 * 1024:
+            logging.warning(
+                f"Resident memory of {rss // (1024 * 1024)} MB exceeds the ceiling of {max_rss} MB.")
+            logging.warning("Progress is stored, rerun to continue the download.")
+            return True
+        return False
 
     def work_on_stack(self, stack):
+        """Download all unfinished lessons. Returns False if the memory ceiling stopped the download early."""
         # stack
         # key lessonurl:  path, Done?
         lessons_counter = dict()
         old_cwd = os.getcwd()
-        for sublesson in stack["lesson"]:
-
-            lesson_url = sublesson
-            path = stack["lesson"][sublesson][0]
-            isFinished = stack["lesson"][sublesson][-1]
+        if self.m_arguments.get("index"):
+            self.open_index()
+        for lesson_url, path, metadata, isFinished in self.iterate_stack(stack):
             if lessons_counter.get(path) is None:
                 lessons_counter[path] = 0
             lessons_counter[path] += 1
             if isFinished == True:
                 logging.debug("Skipping Lesson" + str(lessons_counter[path]))
+                if self.m_index is not None and not self.m_index.has_lesson(lesson_url):
+                    self.index_saved_lesson(
+                        lesson_url, path, lessons_counter[path], metadata)
                 continue
 
             lesson_number = lessons_counter[path]
             os.chdir(path)
 
             root_url, _ = self.parse_url(lesson_url)
+            self.m_saved_files = []
             lesson_soup = self.get_soup(lesson_url)
             self.save_file(
                 lesson_url, f'{str(lesson_number).zfill(3)} - {lesson_soup.title.text}.html')
@@ -488,11 +1035,18 @@ class LanguagePod101Downloader:
                 self.download_videos(lesson_number, lesson_soup)
             if self.m_arguments.get("document"):
                 self.download_pdfs(root_url, lesson_soup)
+            voc_scraper = None
             if self.m_arguments.get("anki_deck"):
-                self.download_vocabulary(root_url, lesson_soup)
+                voc_scraper = self.download_vocabulary(root_url, lesson_soup)
+            elif self.m_index is not None:
+                voc_scraper, _ = self.scrape_vocabulary(root_url, lesson_soup)
+            if self.m_index is not None:
+                self.m_index.add_lesson(lesson_url, path, lesson_number, lesson_soup.title.text, metadata,
+                                        list(voc_scraper.cards.values()), self.m_saved_files)
 
-            stack["lesson"][sublesson][-1] = True
-            self.save_download_stack(stack)
+            self.mark_lesson_finished(stack, lesson_url)
+            self.release_soup(lesson_soup)
+            del lesson_soup, voc_scraper
 
             if self.m_arguments.get("min_delay") and self.m_arguments.get("max_delay"):
                 delay = random.randrange(
@@ -500,37 +1054,65 @@ class LanguagePod101Downloader:
                 logging.debug("Sleeping for " + str(delay) + " seconds")
                 time.sleep(delay)
             os.chdir(old_cwd)
+            if self.check_memory_ceiling():
+                if self.m_index is not None:
+                    self.m_index.close()
+                return False
         # empty stack and save
-        stack = None
-        self.save_download_stack(stack)
+        self.finish_download_stack(stack["start_url"])
+        if self.m_index is not None:
+            self.m_index.close()
+        return True
 
     def force_new_download_stack(self):
-        if self.m_arguments.get("force-new-download-stack") is None:
+        if self.m_arguments.get("force_new_download_stack") is None:
             return False
 
-        if self.m_arguments.get("force-new-download-stack") is False:
+        if self.m_arguments.get("force_new_download_stack") is False:
             return False
         else:
             return True
 
 
 def main(username, password, url, args):
-    USERNAME = username or input('Username (mail): ')
-    PASSWORD = password or getpass('Password: ')
+    STARTUP_TIMER.mark("config")
     level_url = url or input(
         'Please enter URL of the study level for the desired language. For example:\n'
         ' * https://www.japanesepod101.com/lesson-library/absolute-beginner\n'
         ' * https://www.spanishpod101.com/lesson-library/intermediate\n'
         ' * https://www.chineseclass101.com/lesson-library/advanced\n'
     )
+    STARTUP_TIMER.skip()
     lpd = LanguagePod101Downloader(args)
+    if lpd.m_arguments.get("index"):
+        lpd.open_index()
+        lpd.backfill_index()
+        STARTUP_TIMER.mark("index backfill")
+    if lpd.nothing_to_do(level_url):
+        STARTUP_TIMER.mark("resume check")
+        STARTUP_TIMER.report()
+        logging.info('Nothing to do, the level is already downloaded.')
+        if lpd.m_index is not None:
+            lpd.m_index.close()
+        return
+    STARTUP_TIMER.mark("resume check")
+
+    USERNAME = username or input('Username (mail): ')
+    PASSWORD = password or getpass('Password: ')
+    STARTUP_TIMER.skip()
+    lpd.import_dependencies()
+    STARTUP_TIMER.mark("heavy imports")
     lpd.authenticate(level_url, USERNAME, PASSWORD)
+    STARTUP_TIMER.mark("authentication")
     stack = None
     if not lpd.force_new_download_stack():
         stack = lpd.load_download_stack()
     if stack is None:
         stack = lpd.create_download_stack(level_url)
-    lpd.work_on_stack(stack)
+    STARTUP_TIMER.mark("download stack")
+    STARTUP_TIMER.report()
+    if not lpd.work_on_stack(stack):
+        exit(EXIT_MEMORY_CEILING)
 
     logging.info('Yatta! Finished downloading the level!')
 
@@ -565,6 +1147,24 @@ def get_input_arguments():
                         help='Create anki decks from vocabulary')
     parser.add_argument('--download_all_videos', default=False,
                         type=bool, help='Downloads all videos independent of quality')
+    parser.add_argument('--video_quality',
+                        help='Video rendition to download: best, smallest, all or a preferred order e.g. "m,h,l"')
+    parser.add_argument('--max_bandwidth', type=int,
+                        help='Cap for the overall download rate in bytes per second')
+    parser.add_argument('--session_pool_size', type=int,
+                        help='Number of logged in sessions kept for concurrent workers. Downloads run one at a time for now, keep the default of 1')
+    parser.add_argument('--session_max_age', type=int,
+                        help='Log in again proactively once a session is older than this many seconds')
+    parser.add_argument('--low_memory', default=False,
+                        help='Free pages after each lesson and keep the download stack on disk')
+    parser.add_argument('--max_rss', type=int,
+                        help='Stop once the resident memory exceeds this many megabytes, rerun to continue')
+    parser.add_argument('--refresh_interval', type=int,
+                        help='Seconds after a finished download in which reruns exit right away instead of looking for new lessons')
+    parser.add_argument('--index', default=False,
+                        help='Add lessons, vocabulary and media to a searchable index, query it with archive_index.py')
+    parser.add_argument('--index_file',
+                        help='Location of the archive index')
     args = parser.parse_args()
     vargs = vars(args)
     if args.config is not None:
@@ -615,6 +1215,7 @@ def setupLoging():
 
 
 if __name__ == '__main__':
+    STARTUP_TIMER.mark("imports")
     setupLoging()
     args = get_input_arguments()
     main(args.username, args.password, args.url, args)